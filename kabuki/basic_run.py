@@ -8,6 +8,12 @@ import base64
 import os
 import sys
 import signal
+import shlex
+try:
+    # the libyaml based loader is much faster when it is available
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 yaml_path = os.path.expanduser("~/.local/var/")
 
@@ -23,23 +29,40 @@ def load_data_from_yaml(computer_override):
         machine_path = global_path+".yaml"
     else:
         raise RuntimeError(f"Machine config not found at {yaml_path}{computer_override}.yaml or at {computer_override}.yaml. Please define a correct config")
-    machine_data = yaml.safe_load(open(machine_path))
+    with open(machine_path) as machine_file:
+        machine_data = yaml.load(machine_file, Loader=SafeLoader)
     return machine_data
 
 def rand_fname(suffix=""):
     return base64.b16encode(os.urandom(12)).decode("utf-8") + suffix
 
+# reuse one ssh connection per host for all the ssh/scp calls made to it.
+# The sockets live in ~/.ssh so other users cannot plant a fake master in their place
+ssh_control_dir = os.path.expanduser("~/.ssh")
+ssh_multiplex_options = "-o ControlMaster=auto -o ControlPath=~/.ssh/kabuki-%C -o ControlPersist=600"
+
+def make_ssh_control_dir():
+    os.makedirs(ssh_control_dir, mode=0o700, exist_ok=True)
+
 def make_scp_command_forward(source_file, dest_file, machine_config):
-    return f"scp -P {machine_config['port']} -i {machine_config['ssh_key_path']} {source_file} {machine_config['username']}@{machine_config['ip']}:{dest_file}".split(" ")
+    return f"scp {ssh_multiplex_options} -P {machine_config['port']} -i {machine_config['ssh_key_path']} {source_file} {machine_config['username']}@{machine_config['ip']}:{dest_file}".split(" ")
 
 def make_scp_command_backward(source_file, dest_file, machine_config):
-    return f"scp -P {machine_config['port']} -i {machine_config['ssh_key_path']} {machine_config['username']}@{machine_config['ip']}:{dest_file} {source_file}".split(" ")
+    return f"scp {ssh_multiplex_options} -P {machine_config['port']} -i {machine_config['ssh_key_path']} {machine_config['username']}@{machine_config['ip']}:{dest_file} {source_file}".split(" ")
 
 def make_ssh_command(machine_config, command, open_terminal=False):
-    ssh_command = f"ssh -T -o StrictHostKeyChecking=no -o ConnectTimeout=5 -p {machine_config['port']} -i {machine_config['ssh_key_path']} {machine_config['username']}@{machine_config['ip']}"
+    ssh_command = f"ssh -T -o StrictHostKeyChecking=no -o ConnectTimeout=5 {ssh_multiplex_options} -p {machine_config['port']} -i {machine_config['ssh_key_path']} {machine_config['username']}@{machine_config['ip']}"
     final_command = ssh_command.split(" ") + [command]
     return final_command
 
+def make_ssh_control_command(machine_config, control_args):
+    '''
+    ssh command for managing the shared master connection,
+    e.g. control_args="-O check" to test for one, "-M -N -f" to open one in the background
+    '''
+    ssh_command = f"ssh -o StrictHostKeyChecking=no -o ConnectTimeout=5 {ssh_multiplex_options} {control_args} -p {machine_config['port']} -i {machine_config['ssh_key_path']} {machine_config['username']}@{machine_config['ip']}"
+    return ssh_command.split(" ")
+
 def parse_args(args_list):
     parser = argparse.ArgumentParser(description='Run a simple command')
     parser.add_argument('--copy-forward', nargs='*', default=[], help='Folders to copy when running the command. Defaults to everything in the current working directory')
@@ -54,8 +77,19 @@ def parse_args(args_list):
 def printe(*args):
     print(*args, file=sys.stderr)
 
+def signal_ready():
+    '''
+    tells execute_batch, if it started this job, that local setup is done
+    and the next job can be launched
+    '''
+    ready_fd = os.environ.pop("KABUKI_READY_FD", None)
+    if ready_fd is not None:
+        os.write(int(ready_fd), b"1")
+        os.close(int(ready_fd))
+
 def main():
     args = parse_args(sys.argv[1:])
+    make_ssh_control_dir()
     printe(args.command)
 
     machine_config = load_data_from_yaml(args.machine)
@@ -85,15 +119,17 @@ def main():
             script_file.write(script_contents.encode("utf-8"))
             script_file.flush()
 
-            gather_results_command = f"cd && cd {run_folder} && tar cfm {remote_tar_fname_back} {' '.join(args.copy_backwards)}\n"
+            gather_results_command = f"cd && cd {run_folder} && tar cfm {remote_tar_fname_back} {' '.join(shlex.quote(path) for path in args.copy_backwards)}\n"
 
             fname = tarfile.name
 
             vprint("preparing files for transfer:")
-            tararg = f"tar --exclude job_results --exclude .git -cmf {fname} {' '.join(args.copy_forward)} {script_name}"
+            tararg = f"tar --exclude job_results --exclude .git -cmf {fname} {' '.join(shlex.quote(path) for path in args.copy_forward)} {script_name}"
             vprint(tararg)
             subprocess.run(tararg,shell=True)
 
+        signal_ready()
+
         vprint("transfering files to remote:")
         copy_forward_cmd = make_scp_command_forward(fname, remote_tar_fname, machine_config)
         vprint(" ".join(copy_forward_cmd))
@@ -1,31 +1,57 @@
 #!/usr/bin/python3
 import argparse
+import asyncio
+import collections
 import tempfile
 import yaml
 import json
 import subprocess
 import base64
 import re
+import select
+import selectors
 import sys
 import time
 import shlex
-import copy
+import functools
+import hashlib
+import heapq
 import os
 import signal
 from kabuki import basic_run
 from kabuki.query_machine_info import get_full_command, parse_full_output
 
 my_folder = os.path.dirname(os.path.realpath(__file__))
+# with --adaptive-slots, a job failing sooner than this after launch gives up its slot
+early_failure_seconds = 30
+# per line override of --gpu-memory-required in batch files
+gpu_memory_directive = re.compile(r"#\s*--gpu-memory-required[= ]\s*(\d+)\s*$")
 
-def run_all(commands):
+@functools.lru_cache(maxsize=None)
+def _load_yaml_cached(path):
+    return basic_run.load_data_from_yaml(path)
+
+_parsed_output_cache = {}
+
+def _parse_full_output_cached(out):
+    # keyed on a digest so the raw machine dumps are not kept alive
+    key = hashlib.sha1(out.encode("utf-8")).digest()
+    if key not in _parsed_output_cache:
+        _parsed_output_cache[key] = parse_full_output(out)
+    return _parsed_output_cache[key]
+
+async def run_all(commands):
     procs = []
     for command in commands:
-        proc = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        proc = await asyncio.create_subprocess_exec(*command,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
         procs.append(proc)
+    # drain every ssh connection at once, so total time is that of the slowest machine
+    results = await asyncio.gather(*[proc.communicate() for proc in procs])
     outputs = []
-    for proc in procs:
-        out, err = proc.communicate()
-        print(err,file=sys.stderr)
+    for proc, (out, err) in zip(procs, results):
+        # pass the remote stderr through as is, rather than printing its bytes repr
+        sys.stderr.buffer.write(err)
+        sys.stderr.buffer.flush()
         if proc.returncode != 0:
             out = None
         else:
@@ -33,91 +59,263 @@ def run_all(commands):
         outputs.append(out)
     return outputs
 
+async def open_master_connections(machines):
+    '''
+    makes sure each distinct host has a master ssh connection, so that
+    later ssh and scp calls skip the connection handshake
+    '''
+    async def open_master(machine_config):
+        check = await asyncio.create_subprocess_exec(*basic_run.make_ssh_control_command(machine_config, "-O check"),stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+        if await check.wait() != 0:
+            # the master forks into the background, so it must not hold on to a pipe
+            master = await asyncio.create_subprocess_exec(*basic_run.make_ssh_control_command(machine_config, "-M -N -f"),stdout=subprocess.DEVNULL)
+            await master.wait()
+
+    basic_run.make_ssh_control_dir()
+    hosts = {(mac['username'], mac['ip'], mac['port']): mac for mac in machines}
+    await asyncio.gather(*[open_master(mac) for mac in hosts.values()])
+
 def find_all_machine_info(machines):
     cmd = get_full_command()
+    asyncio.run(open_master_connections(machines))
     commands = [basic_run.make_ssh_command(mac, cmd) for mac in machines]
-    outputs = run_all(commands)
+    outputs = asyncio.run(run_all(commands))
     if not all(outputs):
         fail_machines = [mach for out,mach in zip(outputs, machines) if out is None]
         raise RuntimeError("could not connect to machines: "+json.dumps(fail_machines))
-    parsed_outs = [parse_full_output(out) for out in outputs]
+    parsed_outs = [_parse_full_output_cached(out) for out in outputs]
     return parsed_outs
 
-def machine_limit_over(machine_limit):
+def machine_limit_over(machine_limit, gpus=None):
+    '''
+    gpus limits the gpu checks to the given gpus, for when the rest are known to be within limits
+    '''
+    if gpus is None:
+        gpus = machine_limit['gpus']
     return (machine_limit['reserved'] > 1 or
-        machine_limit['cpu_count'] < -2 or
+        machine_limit['cpu_count'] < 0 or
         machine_limit['mem_free'] < 0 or
-        any(gpu['free'] < 0 for gpu in machine_limit['gpus']) or
-        any(gpu['utilization'] > 1.2 for gpu in machine_limit['gpus']) or
-        any(gpu['reserved'] > 1 for gpu in machine_limit['gpus']))
+        any(gpu['free'] < 0 or gpu['utilization'] > 1.0 or gpu['reserved'] > 1 for gpu in gpus))
+
+def gpu_priority(gpu, args):
+    '''
+    ordering used to pick a gpu: unreserved first, then ones the job fits on,
+    then least utilized, then most free memory
+    '''
+    # must agree with machine_limit_over, where a gpu left with exactly 0 free memory still fits
+    return (gpu['reserved'], gpu['free'] < args.gpu_memory_required, gpu['utilization'], -gpu['free'])
 
 def subtract_process_req(machine_limit, args):
+    '''
+    charges one more process to machine_limit and returns the gpu index it was given.
+    If the process does not fit, the charge is rolled back and None is returned
+    '''
+    machine_before = (machine_limit['reserved'], machine_limit['cpu_count'], machine_limit['mem_free'])
     if args.reserve:
         machine_limit['reserved'] += 1
     machine_limit['cpu_count'] -= args.num_cpus
     machine_limit['mem_free'] -= args.memory_required
     gpu_idx = 0
     if not args.no_gpu_required:
-        gpu_choice = None
-        for i,gpu in enumerate(machine_limit['gpus']):
-            if gpu_choice is None or gpu_choice['reserved'] or gpu_choice['free'] - args.gpu_memory_required <= 0 or gpu_choice['utilization'] > gpu['utilization']:
-                gpu_choice = gpu
-                gpu_idx = i
+        gpu_heap = machine_limit['gpu_heap']
+        gpu_entry = heapq.heappop(gpu_heap)
+        gpu_idx = gpu_entry[-1]
+        gpu_choice = machine_limit['gpus'][gpu_idx]
+        gpu_before = dict(gpu_choice)
         gpu_choice['free'] -= args.gpu_memory_required
         gpu_choice['utilization'] += args.gpu_utilization
+        # only jobs that asked for a reserved gpu mark it as taken
         if not args.no_reserve_gpu:
             gpu_choice['reserved'] += 1
-    return gpu_idx
 
-def init_machine_limit(machine_limit):
+    # the machine was within limits before this charge, so only the chosen gpu can have gone over
+    reverted = machine_limit_over(machine_limit, [] if args.no_gpu_required else [gpu_choice])
+    if reverted:
+        machine_limit['reserved'], machine_limit['cpu_count'], machine_limit['mem_free'] = machine_before
+    if not args.no_gpu_required:
+        if reverted:
+            gpu_choice.update(gpu_before)
+            heapq.heappush(gpu_heap, gpu_entry)
+        else:
+            heapq.heappush(gpu_heap, (*gpu_priority(gpu_choice, args), gpu_idx))
+    return None if reverted else gpu_idx
+
+def init_machine_limit(machine_limit, args):
     machine_limit['reserved'] = 0
     machine_limit['cpu_count'] *= (1-machine_limit['cpu_usage'])
     for gpu in machine_limit['gpus']:
         gpu['reserved'] = 0
+    machine_limit['gpu_heap'] = [(*gpu_priority(gpu, args), i) for i, gpu in enumerate(machine_limit['gpus'])]
+    heapq.heapify(machine_limit['gpu_heap'])
+
+def machine_process_cap(machine_limit, args):
+    '''
+    most processes the machine wide limits (reservation, cpus and memory) allow,
+    or None if the job does not consume any of them
+    '''
+    caps = []
+    if args.reserve:
+        caps.append(1)
+    if args.num_cpus > 0:
+        caps.append(int(machine_limit['cpu_count'] // args.num_cpus))
+    if args.memory_required > 0:
+        caps.append(int(machine_limit['mem_free'] // args.memory_required))
+    return max(min(caps), 0) if caps else None
 
 def get_process_limit(machine_limit, args):
     '''
     machine limit looks like this:
     {"cpu_usage": 0.124, "mem_free": 30607, "cpu_count": 24, "gpus": [{"name": "GeForce RTX 2060", "mem": 5934, "free": 5933, "utilization": 0.0}, {"name": "GeForce RTX 2060", "mem": 5932, "free": 5931, "utilization": 0.0}]}
     '''
-    machine_limit = copy.deepcopy(machine_limit)
+    # only the gpu list holds nested state, so a one level copy is enough
+    machine_limit = {**machine_limit, 'gpus': [dict(gpu) for gpu in machine_limit['gpus']]}
 
     if not machine_limit['gpus'] and not args.no_gpu_required:
         return []
 
-    init_machine_limit(machine_limit)
+    init_machine_limit(machine_limit, args)
+    process_cap = machine_process_cap(machine_limit, args)
+    if args.no_gpu_required and process_cap is not None:
+        return [0] * process_cap
+
     gpu_choices = []
-    while True:
+    while process_cap is None or len(gpu_choices) < process_cap:
         gpu_choice = subtract_process_req(machine_limit, args)
-        if machine_limit_over(machine_limit):
+        if gpu_choice is None:
             break
         gpu_choices.append(gpu_choice)
     return gpu_choices
 
-def make_basic_run_command(machine, job_name, export_prefix, command, gpu_choice, args):
-    basic_cmd = f"python -u {os.path.join(my_folder,'basic_run.py')} --copy-forward {' '.join(args.copy_forward)}  --copy-backwards {' '.join(args.copy_backwards)} --machine={machine} --job-name={job_name} {'--verbose' if args.verbose else ''}".split()
-    cmd = basic_cmd + [export_prefix+" "+command]
+def reap_finished_jobs(running_jobs, exited_processes=None):
+    '''
+    collects the exit status of every job that has finished since the last call.
+    running_jobs maps pid to slot information, finished entries are removed from it.
+    exited_processes are the processes wait_for_job_exit saw exit, if it uses pidfds;
+    otherwise any child that has exited is reaped
+    '''
+    finished = []
+    if exited_processes is not None:
+        for process in exited_processes:
+            if process.poll() is not None and process.pid in running_jobs:
+                finished.append((running_jobs.pop(process.pid), process.returncode))
+        return finished
+    while running_jobs:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            break
+        if pid in running_jobs:
+            job = running_jobs.pop(pid)
+            process = job[2]
+            # the pid is reaped, so tell the Popen object it is done
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            finished.append((job, process.returncode))
+    return finished
+
+def make_job_selector():
+    '''
+    returns a selector that becomes readable when a launched job exits, and whether
+    jobs need registering with watch_job. Uses a pidfd per job where the platform
+    supports it, otherwise a wakeup pipe written to on SIGCHLD
+    '''
+    selector = selectors.DefaultSelector()
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+        return selector, True
+    except (AttributeError, OSError):
+        wakeup_read_fd, wakeup_write_fd = os.pipe()
+        os.set_blocking(wakeup_read_fd, False)
+        os.set_blocking(wakeup_write_fd, False)
+        signal.set_wakeup_fd(wakeup_write_fd)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        selector.register(wakeup_read_fd, selectors.EVENT_READ)
+        return selector, False
+
+def watch_job(selector, process):
+    selector.register(os.pidfd_open(process.pid), selectors.EVENT_READ, process)
+
+def wait_for_job_exit(selector, timeout=1.0):
+    '''
+    waits for a job to exit, returns the processes whose pidfds became readable
+    '''
+    exited_processes = []
+    for key, _ in selector.select(timeout):
+        if key.data is None:
+            # drain the SIGCHLD wakeup pipe
+            try:
+                while os.read(key.fd, 512):
+                    pass
+            except BlockingIOError:
+                pass
+        else:
+            selector.unregister(key.fd)
+            os.close(key.fd)
+            exited_processes.append(key.data)
+    return exited_processes
+
+def wait_for_ready(ready_fd, timeout=2.0):
+    '''
+    blocks until a launched job signals on its readiness pipe, exits, or timeout seconds pass.
+    Closes ready_fd
+    '''
+    try:
+        readable, _, _ = select.select([ready_fd], [], [], timeout)
+        if readable:
+            os.read(ready_fd, 1)
+    finally:
+        os.close(ready_fd)
+
+def split_gpu_memory_directive(line, default_gpu_memory):
+    '''
+    splits an optional trailing "# --gpu-memory-required=N" comment off a batch line.
+    Returns the command and the gpu memory it requires
+    '''
+    match = gpu_memory_directive.search(line)
+    if match is None:
+        return line, default_gpu_memory
+    return line[:match.start()].rstrip(), int(match.group(1))
+
+def make_basic_run_prefix(args):
+    '''
+    part of the basic_run command that is the same for every job run with these args
+    '''
+    # the running interpreter, so the job sees the same environment and skips a PATH search
+    return [sys.executable, "-u", os.path.join(my_folder,'basic_run.py'), "--copy-forward", *args.copy_forward, "--copy-backwards", *args.copy_backwards]
+
+def make_basic_run_command(machine, job_name, export_prefix, command, gpu_choice, args, basic_prefix=None):
+    if basic_prefix is None:
+        basic_prefix = make_basic_run_prefix(args)
+    cmd = basic_prefix + [f"--machine={machine}", f"--job-name={job_name}"]
+    if args.verbose:
+        cmd.append("--verbose")
+    cmd.append(export_prefix+" "+command)
     return cmd
 
 def make_kabuki_run_command(machine, job_name, export_prefix, command, gpu_choice, args):
-    final_command = command
+    split_cmd = shlex.split(command)[1:]
     if "--copy-forward" not in command:
-        final_command += f" --copy-forward {' '.join(args.copy_forward)} "
+        split_cmd += ["--copy-forward", *args.copy_forward]
     if "--copy-backwards" not in command:
-        final_command += f" --copy-backwards {' '.join(args.copy_backwards)} "
+        split_cmd += ["--copy-backwards", *args.copy_backwards]
     if "--job-name" not in command:
-        final_command += f" --job-name {job_name} "
+        split_cmd += ["--job-name", job_name]
     if args.verbose:
-        final_command += f" --verbose "
-    final_command += f" --machine {machine} "
+        split_cmd.append("--verbose")
+    split_cmd += ["--machine", machine]
 
-    split_cmd = shlex.split(final_command)[1:]
     parse_results = basic_run.parse_args(split_cmd)
-    # final_command = final_command.replace(parse_results.command, f" {export_prefix} {parse_results.command} ")
-    # catted_cmd =  f" {export_prefix} {parse_results.command} "
     resulting_command = make_basic_run_command(machine, parse_results.job_name, export_prefix, parse_results.command, gpu_choice, parse_results)
 
     return resulting_command, parse_results.job_name
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"must be an integer, got {value!r}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
 #
 def main():
     parser = argparse.ArgumentParser(
@@ -134,6 +332,8 @@ def main():
     parser.add_argument('--no-gpu-required', action="store_true", help='is a gpu required for the job')
     parser.add_argument('--gpu-memory-required', type=int, default=1000, help='gpu memory to reserve for the job')
     parser.add_argument('--gpu-utilization', type=float, default=0.75, help='gpu utilization consumed')
+    parser.add_argument('--max-parallel', type=positive_int, default=None, help='most jobs to run at once on each machine, on top of the hardware limits')
+    parser.add_argument('--adaptive-slots', action="store_true", help=f'when a job fails within {early_failure_seconds} seconds of starting, assume its machine is oversubscribed and run one fewer job on it for the rest of the batch')
     parser.add_argument('--verbose', action="store_true", help='print out debug information')
     parser.add_argument('--dry-run', action="store_true", help='just print out first round of commands')
     parser.add_argument('--kabuki-commands', action="store_true", help='Whether the batch file should be interpreted as kabuki commands instead of bash commands')
@@ -141,81 +341,133 @@ def main():
 
     args = parser.parse_args()
 
-    lines = open(args.filename).readlines()
-    machine_configs = [basic_run.load_data_from_yaml(mac) for mac in args.machines]
+    with open(args.filename) as batch_file:
+        split_lines = [split_gpu_memory_directive(line.rstrip("\r\n"), args.gpu_memory_required) for line in batch_file]
+    lines = [command for command, gpu_memory in split_lines]
+    line_gpu_memory = [gpu_memory for command, gpu_memory in split_lines]
+    if args.no_gpu_required:
+        line_gpu_memory = [args.gpu_memory_required]*len(lines)
+    machine_configs = [_load_yaml_cached(mac) for mac in args.machines]
     machine_infos = find_all_machine_info(machine_configs)
-    machine_gpu_choices = [get_process_limit(info, args) for info in machine_infos]
-    machine_proc_limits = [len(c) for c in machine_gpu_choices]
-    print("machine limits: ", {name:limit for name, limit in zip(args.machines,machine_proc_limits)})
-    print("machine gpu choices:",machine_gpu_choices)
-    machine_procs = [[None for i in range(limit)] for limit in machine_proc_limits]
+    # jobs are run in groups by gpu memory size, largest first, each group with its own machine limits
+    size_classes = sorted(set(line_gpu_memory), reverse=True)
+    class_gpu_choices = []
+    for gpu_memory_required in size_classes:
+        class_args = argparse.Namespace(**{**vars(args), "gpu_memory_required": gpu_memory_required})
+        machine_gpu_choices = [get_process_limit(info, class_args) for info in machine_infos]
+        if args.max_parallel is not None:
+            machine_gpu_choices = [gpu_choices[:args.max_parallel] for gpu_choices in machine_gpu_choices]
+        class_gpu_choices.append(machine_gpu_choices)
+        if len(size_classes) > 1:
+            print(f"jobs requiring {gpu_memory_required} gpu memory:")
+        print("machine limits: ", {name:len(c) for name, c in zip(args.machines,machine_gpu_choices)})
+        print("machine gpu choices:",machine_gpu_choices)
     save_filename = args.filename.replace("/","_")
     job_names = [f"{save_filename}.{line_num+1}" for line_num in range(len(lines))]
+    out_paths = [f"./job_results/{job_name}.out" for job_name in job_names]
+    err_paths = [f"./job_results/{job_name}.err" for job_name in job_names]
+    os.makedirs("./job_results/",exist_ok=True)
+    # one directory read instead of a stat per job
+    existing_results = {entry.name for entry in os.scandir("./job_results/")}
     for line_num in range(len(lines)):
-        if os.path.exists(f"./job_results/{job_names[line_num]}"):
+        if job_names[line_num] in existing_results:
             print(f"WARNING: job results already exists for line {line_num+1}, skipping evaluation: delete if you wish to rerun")
 
-    os.makedirs("./job_results/",exist_ok=True)
-    line_num = 0
+    # wake the scheduler as soon as any job exits instead of sleeping a fixed interval
+    job_selector, use_pidfds = make_job_selector()
+    basic_prefix = make_basic_run_prefix(args)
+    running_jobs = {}
+    # slots given up by --adaptive-slots stay given up in later size classes
+    retired_slots = [0 for mac in args.machines]
     try:
-        all_done = False
-        while not all_done:
-            all_done = True
-            waiting_only = True
-            for mac,gpu_choices,procs in zip(args.machines, machine_gpu_choices, machine_procs):
-                for i,(gpu_choice, proc) in enumerate(zip(gpu_choices, procs)):
-                    if proc is not None and proc[1].poll() is not None:
-                        message = "finished" if proc[1].returncode == 0 else "failed"
-                        finished_num = proc[0]
-                        job_name = job_names[finished_num]
-                        print(f"{message}: {job_name}; {lines[finished_num].strip()}",flush=True)
-                        proc = procs[i] = None
-                    if proc is None and line_num < len(lines):
-                        export_prefix = f"export CUDA_VISIBLE_DEVICES={gpu_choice} &&" if not args.reserve and not args.no_gpu_required else ""
-                        command = lines[line_num].strip()
-                        job_name = job_names[line_num]
-
-                        if args.kabuki_commands:
-                            job_cmd, new_job_name = make_kabuki_run_command(mac, job_name, export_prefix, command, gpu_choice, args)
-                            job_name = job_names[line_num] = new_job_name
-                        else:
-                            job_cmd = make_basic_run_command(mac, job_name, export_prefix, command, gpu_choice, args)
-                        print(job_name)
-                        if os.path.exists(f"./job_results/{job_name}"):
-                            print("skipping", command,flush=True)
+        for gpu_memory_required, machine_gpu_choices in zip(size_classes, class_gpu_choices):
+            if any(retired_slots):
+                machine_gpu_choices = [gpu_choices[:max(len(gpu_choices)-retired, min(len(gpu_choices), 1))] for gpu_choices, retired in zip(machine_gpu_choices, retired_slots)]
+                print(f"machine limits for jobs requiring {gpu_memory_required} gpu memory after reductions: ", {name:len(c) for name, c in zip(args.machines,machine_gpu_choices)},flush=True)
+            machine_proc_limits = [len(c) for c in machine_gpu_choices]
+            # slots that can take a job right now, in machine order
+            free_slots = collections.deque((mac_idx, i, gpu_choice) for mac_idx, gpu_choices in enumerate(machine_gpu_choices) for i, gpu_choice in enumerate(gpu_choices))
+            pending_lines = collections.deque(line_num for line_num in range(len(lines)) if line_gpu_memory[line_num] == gpu_memory_required)
+            while True:
+                while free_slots and pending_lines:
+                    line_num = pending_lines.popleft()
+                    slot = free_slots.popleft()
+                    mac_idx, i, gpu_choice = slot
+                    mac = args.machines[mac_idx]
+                    export_prefix = f"export CUDA_VISIBLE_DEVICES={gpu_choice} &&" if not args.reserve and not args.no_gpu_required else ""
+                    command = lines[line_num].strip()
+                    job_name = job_names[line_num]
+
+                    if args.kabuki_commands:
+                        job_cmd, new_job_name = make_kabuki_run_command(mac, job_name, export_prefix, command, gpu_choice, args)
+                        job_name = job_names[line_num] = new_job_name
+                        out_paths[line_num] = f"./job_results/{job_name}.out"
+                        err_paths[line_num] = f"./job_results/{job_name}.err"
+                    else:
+                        job_cmd = make_basic_run_command(mac, job_name, export_prefix, command, gpu_choice, args, basic_prefix)
+                    print(job_name)
+                    if job_name in existing_results:
+                        print("skipping", command,flush=True)
+                        free_slots.append(slot)
+                    else:
+                        if args.verbose or args.dry_run:
+                            fancy_job_command = ' '.join(shlex.quote(arg) for arg in job_cmd)
+                            print(fancy_job_command)
+                        if not args.dry_run:
+                            print(f"started: {job_name};  {command}",flush=True)
+                            stdout_fd = os.open(out_paths[line_num], os.O_WRONLY|os.O_CREAT|os.O_APPEND, 0o644)
+                            stderr_fd = os.open(err_paths[line_num], os.O_WRONLY|os.O_CREAT|os.O_APPEND, 0o644)
+                            ready_read_fd, ready_write_fd = os.pipe()
+                            try:
+                                process = subprocess.Popen(job_cmd,stdout=stdout_fd, stderr=stderr_fd, pass_fds=(ready_write_fd,), env={**os.environ, "KABUKI_READY_FD": str(ready_write_fd)})#,creationflags=subprocess.DETACHED_PROCESS)
+                            finally:
+                                # the child writes to the files directly, the scheduler does not need them open
+                                os.close(stdout_fd)
+                                os.close(stderr_fd)
+                                os.close(ready_write_fd)
+                            if use_pidfds:
+                                watch_job(job_selector, process)
+                            wait_for_ready(ready_read_fd)
+                            # basic_run makes up a fresh name for each __random__ job, so those never collide
+                            if job_name != "__random__":
+                                existing_results.add(job_name)
+                            running_jobs[process.pid] = (slot, line_num, process, time.monotonic())
                         else:
-                            if args.verbose or args.dry_run:
-                                fancy_job_command = ' '.join(job_cmd)
-                                print(fancy_job_command)
-                            if not args.dry_run:
-                                print(f"started: {job_name};  {command}",flush=True)
-                                stdout_file = open(f"./job_results/{job_name}.out",'a',buffering=1)
-                                stderr_file = open(f"./job_results/{job_name}.err",'a',buffering=1)
-                                process = subprocess.Popen(job_cmd,stdout=stdout_file, stderr=stderr_file)#,creationflags=subprocess.DETACHED_PROCESS)
-                                time.sleep(0.2)
-                                proc = procs[i] = (line_num, process)
-                        line_num += 1
-                        all_done = False
-                        waiting_only = False
-
-                    if proc is not None:
-                        all_done = False
-            if waiting_only:
-                time.sleep(1)
+                            free_slots.append(slot)
+
+                if not running_jobs:
+                    break
+                exited_processes = wait_for_job_exit(job_selector)
+
+                for (slot, finished_num, process, start_time), returncode in reap_finished_jobs(running_jobs, exited_processes if use_pidfds else None):
+                    message = "finished" if returncode == 0 else "failed"
+                    job_name = job_names[finished_num]
+                    print(f"{message}: {job_name}; {lines[finished_num].strip()}",flush=True)
+                    mac_idx = slot[0]
+                    if (args.adaptive_slots and returncode != 0 and machine_proc_limits[mac_idx] > 1 and
+                            time.monotonic() - start_time < early_failure_seconds):
+                        # most likely ran out of memory, so stop refilling this slot
+                        machine_proc_limits[mac_idx] -= 1
+                        retired_slots[mac_idx] += 1
+                        print(f"reducing job limit of {args.machines[mac_idx]} to {machine_proc_limits[mac_idx]}",flush=True)
+                    else:
+                        free_slots.append(slot)
+
+            if pending_lines:
+                skipped_lines = ', '.join(str(line_num+1) for line_num in pending_lines)
+                if len(size_classes) > 1:
+                    print(f"WARNING: no machine can run jobs requiring {gpu_memory_required} gpu memory, skipping lines {skipped_lines}",flush=True)
+                else:
+                    print(f"WARNING: no machine has a free slot for jobs, skipping lines {skipped_lines}",flush=True)
     except BaseException as be:
         signal.signal(signal.SIGINT, signal.SIG_IGN)
         print("interrupting tasks")
-        for procs in machine_procs:
-            for proc in procs:
-                if proc is not None:
-                    proc[1].send_signal(signal.SIGINT)
+        for slot, line_num, process, start_time in running_jobs.values():
+            process.send_signal(signal.SIGINT)
         print("waiting for tasks to terminate")
-        for procs in machine_procs:
-            for proc in procs:
-                if proc is not None:
-                    proc[1].wait()
+        for slot, line_num, process, start_time in running_jobs.values():
+            process.wait()
         raise be
 
-
 if __name__ == "__main__":
     main()
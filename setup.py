@@ -15,9 +15,8 @@ setuptools.setup(
     keywords=["Machine Learning", "Job Scheduling"],
     packages=setuptools.find_packages(),
     install_requires=[],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     classifiers=[
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         "License :: OSI Approved :: MIT License",
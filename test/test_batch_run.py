@@ -0,0 +1,350 @@
+import argparse
+import contextlib
+import copy
+import io
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+from kabuki import basic_run, batch_run
+from kabuki.batch_run import get_process_limit, split_gpu_memory_directive, make_basic_run_prefix, make_basic_run_command, make_kabuki_run_command
+from kabuki.batch_run import reap_finished_jobs, make_job_selector, watch_job, wait_for_job_exit, wait_for_ready
+
+machine_info = {"cpu_usage": 0.0, "mem_free": 30000, "cpu_count": 8, "gpus": [
+    {"name": "GeForce RTX 2060", "mem": 5934, "free": 5933, "utilization": 0.0},
+    {"name": "GeForce RTX 2060", "mem": 5932, "free": 5931, "utilization": 0.0},
+]}
+
+
+def make_args(**kwargs):
+    defaults = dict(
+        reserve=False,
+        num_cpus=1,
+        memory_required=7000,
+        no_reserve_gpu=False,
+        no_gpu_required=False,
+        gpu_memory_required=1000,
+        gpu_utilization=0.75,
+    )
+    defaults.update(kwargs)
+    return argparse.Namespace(**defaults)
+
+
+class TestProcessLimit(unittest.TestCase):
+    def test_reserved_gpus(self):
+        self.assertEqual(get_process_limit(machine_info, make_args()), [0, 1])
+
+    def test_machine_info_unchanged(self):
+        info = copy.deepcopy(machine_info)
+        get_process_limit(info, make_args(no_reserve_gpu=True, gpu_utilization=0.1))
+        self.assertEqual(info, machine_info)
+
+    def test_cpu_limit_exact(self):
+        gpu_choices = get_process_limit(machine_info, make_args(no_gpu_required=True, num_cpus=2, memory_required=100))
+        self.assertEqual(len(gpu_choices), 4)
+
+    def test_gpu_utilization_not_oversubscribed(self):
+        gpu_choices = get_process_limit(machine_info, make_args(no_reserve_gpu=True, gpu_utilization=0.5, memory_required=100))
+        self.assertEqual(sorted(gpu_choices), [0, 0, 1, 1])
+
+    def test_gpu_memory_limit(self):
+        gpu_choices = get_process_limit(machine_info, make_args(no_reserve_gpu=True, gpu_utilization=0.0, gpu_memory_required=3000, memory_required=100))
+        self.assertEqual(sorted(gpu_choices), [0, 1])
+
+    def test_picks_gpu_that_fits(self):
+        info = copy.deepcopy(machine_info)
+        info["gpus"][0]["free"] = 500
+        self.assertEqual(get_process_limit(info, make_args()), [1])
+
+    def test_exact_fit_gpu(self):
+        info = {**machine_info, "cpu_count": 12, "gpus": [
+            {"name": "GeForce RTX 2060", "mem": 3000, "free": 0, "utilization": 0.3},
+            {"name": "GeForce RTX 2060", "mem": 3000, "free": 3000, "utilization": 0.1},
+        ]}
+        args = make_args(no_reserve_gpu=True, num_cpus=2, memory_required=100, gpu_memory_required=500, gpu_utilization=0.1)
+        self.assertEqual(get_process_limit(info, args), [1, 1, 1, 1, 1, 1])
+
+    def test_reserve_machine(self):
+        self.assertEqual(len(get_process_limit(machine_info, make_args(reserve=True, memory_required=100))), 1)
+
+    def test_no_gpus(self):
+        info = {**machine_info, "gpus": []}
+        self.assertEqual(get_process_limit(info, make_args()), [])
+        self.assertEqual(len(get_process_limit(info, make_args(no_gpu_required=True))), 4)
+
+
+class TestGpuMemoryDirective(unittest.TestCase):
+    def test_directive(self):
+        self.assertEqual(split_gpu_memory_directive("python train.py  # --gpu-memory-required=3000", 1000), ("python train.py", 3000))
+        self.assertEqual(split_gpu_memory_directive("python train.py #--gpu-memory-required 500", 1000), ("python train.py", 500))
+
+    def test_no_directive(self):
+        self.assertEqual(split_gpu_memory_directive("python train.py --lr=0.1 # comment", 1000), ("python train.py --lr=0.1 # comment", 1000))
+
+
+class TestRunCommands(unittest.TestCase):
+    def setUp(self):
+        self.args = argparse.Namespace(copy_forward=["my data", "train.py"], copy_backwards=["results dir"], verbose=False)
+
+    def test_basic_run_command(self):
+        cmd = make_basic_run_command("machine.yaml", "job.1", "export CUDA_VISIBLE_DEVICES=1 &&", "python train.py", 1, self.args)
+        self.assertEqual(cmd[:2], [sys.executable, "-u"])
+        parsed = basic_run.parse_args(cmd[3:])
+        self.assertEqual(parsed.copy_forward, ["my data", "train.py"])
+        self.assertEqual(parsed.copy_backwards, ["results dir"])
+        self.assertEqual(parsed.machine, "machine.yaml")
+        self.assertEqual(parsed.job_name, "job.1")
+        self.assertFalse(parsed.verbose)
+        self.assertEqual(parsed.command, "export CUDA_VISIBLE_DEVICES=1 && python train.py")
+
+    def test_basic_run_prefix(self):
+        self.args.verbose = True
+        prefix = make_basic_run_prefix(self.args)
+        cmd = make_basic_run_command("machine.yaml", "job.1", "", "python train.py", 0, self.args, prefix)
+        self.assertEqual(cmd, make_basic_run_command("machine.yaml", "job.1", "", "python train.py", 0, self.args))
+        self.assertTrue(basic_run.parse_args(cmd[3:]).verbose)
+
+    def test_kabuki_command_defaults(self):
+        cmd, job_name = make_kabuki_run_command("machine.yaml", "job.1", "", "execute_remote 'python train.py'", 0, self.args)
+        self.assertEqual(job_name, "job.1")
+        parsed = basic_run.parse_args(cmd[3:])
+        self.assertEqual(parsed.copy_forward, ["my data", "train.py"])
+        self.assertEqual(parsed.copy_backwards, ["results dir"])
+        self.assertEqual(parsed.machine, "machine.yaml")
+        self.assertEqual(parsed.command, " python train.py")
+
+    def test_kabuki_command_overrides(self):
+        line = "execute_remote --copy-forward 'other data' --copy-backwards out --job-name custom --machine ignored.yaml 'python train.py'"
+        cmd, job_name = make_kabuki_run_command("machine.yaml", "job.1", "", line, 0, self.args)
+        self.assertEqual(job_name, "custom")
+        parsed = basic_run.parse_args(cmd[3:])
+        self.assertEqual(parsed.copy_forward, ["other data"])
+        self.assertEqual(parsed.copy_backwards, ["out"])
+        self.assertEqual(parsed.job_name, "custom")
+        self.assertEqual(parsed.machine, "machine.yaml")
+
+
+# stands in for basic_run: signals readiness like it does, then runs the line locally
+ready_snippet = "import os\nos.write(int(os.environ['KABUKI_READY_FD']), b'1')\n"
+
+
+def local_run_command(machine, job_name, export_prefix, command, gpu_choice, args, basic_prefix=None):
+    return [sys.executable, "-c", ready_snippet + command.strip()]
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+        self.machine_info = {"cpu_usage": 0.0, "mem_free": 30000, "cpu_count": 3, "gpus": []}
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def run_batch(self, lines, *batch_args):
+        with open("batch.sh", "w") as batch_file:
+            batch_file.write("\n".join(lines) + "\n")
+        argv = ["execute_batch", "--machines", "m1", "--memory-required=100", *batch_args, "batch.sh"]
+        output = io.StringIO()
+        with mock.patch.object(sys, "argv", argv), \
+                mock.patch.object(batch_run, "_load_yaml_cached", lambda machine: {}), \
+                mock.patch.object(batch_run, "find_all_machine_info", lambda configs: [copy.deepcopy(self.machine_info) for config in configs]), \
+                mock.patch.object(batch_run, "make_basic_run_command", local_run_command), \
+                contextlib.redirect_stdout(output):
+            batch_run.main()
+        return output.getvalue()
+
+    def test_runs_all_lines(self):
+        output = self.run_batch(["pass", "raise SystemExit(2)", "print('hello')"], "--no-gpu-required")
+        self.assertIn("finished: batch.sh.1", output)
+        self.assertIn("failed: batch.sh.2", output)
+        self.assertIn("finished: batch.sh.3", output)
+        with open("job_results/batch.sh.3.out") as out_file:
+            self.assertEqual(out_file.read(), "hello\n")
+
+    def test_adaptive_slots_retire_early_failures(self):
+        lines = ["raise SystemExit(1)"]*3 + ["pass"]*2
+        output = self.run_batch(lines, "--no-gpu-required", "--adaptive-slots")
+        self.assertIn("machine limits:  {'m1': 3}", output)
+        self.assertIn("reducing job limit of m1 to 2", output)
+        self.assertIn("reducing job limit of m1 to 1", output)
+        self.assertNotIn("to 0", output)
+        self.assertIn("finished: batch.sh.4", output)
+        self.assertIn("finished: batch.sh.5", output)
+
+    def test_failures_keep_slots_without_adaptive_slots(self):
+        output = self.run_batch(["raise SystemExit(1)"]*3 + ["pass"], "--no-gpu-required")
+        self.assertNotIn("reducing job limit", output)
+        self.assertIn("finished: batch.sh.4", output)
+
+    def test_adaptive_slots_carry_into_next_size_class(self):
+        self.machine_info["gpus"] = [{"name": "GeForce RTX 2060", "mem": 10000, "free": 10000, "utilization": 0.0}]
+        lines = ["raise SystemExit(1)  # --gpu-memory-required=2000", "pass", "pass"]
+        output = self.run_batch(lines, "--no-reserve-gpu", "--gpu-utilization=0.1", "--adaptive-slots")
+        self.assertIn("reducing job limit of m1 to 2", output)
+        self.assertIn("machine limits for jobs requiring 1000 gpu memory after reductions:  {'m1': 2}", output)
+        self.assertIn("finished: batch.sh.2", output)
+        self.assertIn("finished: batch.sh.3", output)
+
+    def test_max_parallel(self):
+        output = self.run_batch(["pass"]*2, "--no-gpu-required", "--max-parallel", "1")
+        self.assertIn("machine limits:  {'m1': 1}", output)
+        self.assertIn("finished: batch.sh.2", output)
+
+    def test_max_parallel_must_be_positive(self):
+        with contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                self.run_batch(["pass"], "--no-gpu-required", "--max-parallel", "0")
+
+    def test_size_classes_largest_first(self):
+        self.machine_info["cpu_count"] = 8
+        self.machine_info["gpus"] = [{"name": "GeForce RTX 2060", "mem": 2500, "free": 2500, "utilization": 0.0}]
+        lines = ["pass  # --gpu-memory-required=500", "pass", "pass  # --gpu-memory-required=2000"]
+        output = self.run_batch(lines, "--no-reserve-gpu", "--gpu-utilization=0.0")
+        self.assertIn("jobs requiring 2000 gpu memory:\nmachine limits:  {'m1': 1}", output)
+        self.assertIn("jobs requiring 1000 gpu memory:\nmachine limits:  {'m1': 2}", output)
+        self.assertIn("jobs requiring 500 gpu memory:\nmachine limits:  {'m1': 5}", output)
+        started = [line.split(";")[0] for line in output.splitlines() if line.startswith("started:")]
+        self.assertEqual(started, ["started: batch.sh.3", "started: batch.sh.2", "started: batch.sh.1"])
+
+    def test_skips_size_class_that_does_not_fit(self):
+        self.machine_info["gpus"] = [{"name": "GeForce RTX 2060", "mem": 2500, "free": 2500, "utilization": 0.0}]
+        lines = ["pass  # --gpu-memory-required=9000", "pass"]
+        output = self.run_batch(lines, "--no-reserve-gpu", "--gpu-utilization=0.0")
+        self.assertIn("WARNING: no machine can run jobs requiring 9000 gpu memory, skipping lines 1", output)
+        self.assertNotIn("started: batch.sh.1", output)
+        self.assertIn("finished: batch.sh.2", output)
+
+    def test_skips_lines_without_free_slots(self):
+        output = self.run_batch(["pass"]*2, "--no-gpu-required", "--memory-required=99999")
+        self.assertIn("WARNING: no machine has a free slot for jobs, skipping lines 1, 2", output)
+        self.assertNotIn("gpu memory", output)
+
+    def test_duplicate_job_names_skipped(self):
+        lines = ["execute_remote --job-name=dup 'pass'"]*2
+        output = self.run_batch(lines, "--no-gpu-required", "--kabuki-commands")
+        self.assertEqual(output.count("started: dup;"), 1)
+        self.assertIn("skipping", output)
+
+    def test_random_job_names_not_skipped(self):
+        lines = ["execute_remote --job-name=__random__ 'pass'"]*2
+        output = self.run_batch(lines, "--no-gpu-required", "--kabuki-commands", "--max-parallel", "1")
+        self.assertEqual(output.count("started: __random__;"), 2)
+        self.assertNotIn("skipping", output)
+
+    def test_line_numbers_follow_newlines(self):
+        output = self.run_batch(["print('page\x0cbreak')", "pass"], "--no-gpu-required")
+        self.assertIn("finished: batch.sh.2; pass", output)
+        self.assertNotIn("batch.sh.3", output)
+
+
+def start_child(code, **kwargs):
+    return subprocess.Popen([sys.executable, "-c", code], **kwargs)
+
+
+def assert_fd_closed(test, fd):
+    with test.assertRaises(OSError):
+        os.fstat(fd)
+
+
+class TestJobWaiting(unittest.TestCase):
+    def collect(self, selector, use_pidfds, running_jobs):
+        finished = []
+        deadline = time.monotonic() + 10
+        while running_jobs and time.monotonic() < deadline:
+            exited_processes = wait_for_job_exit(selector)
+            finished += reap_finished_jobs(running_jobs, exited_processes if use_pidfds else None)
+        return finished
+
+    def start_jobs(self, selector, use_pidfds):
+        processes = [start_child("raise SystemExit(3)"), start_child("pass"), start_child("import time; time.sleep(30)")]
+        running_jobs = {process.pid: ("slot", line_num, process, time.monotonic()) for line_num, process in enumerate(processes)}
+        if use_pidfds:
+            for process in processes:
+                watch_job(selector, process)
+        processes[2].terminate()
+        return processes, running_jobs
+
+    def check_finished(self, processes, running_jobs, finished):
+        self.assertEqual(running_jobs, {})
+        self.assertEqual(sorted((job[1], returncode) for job, returncode in finished), [(0, 3), (1, 0), (2, -signal.SIGTERM)])
+        self.assertEqual([process.returncode for process in processes], [3, 0, -signal.SIGTERM])
+
+    def test_pidfds(self):
+        selector, use_pidfds = make_job_selector()
+        self.addCleanup(selector.close)
+        if not use_pidfds:
+            self.skipTest("pidfds are not supported here")
+        processes, running_jobs = self.start_jobs(selector, use_pidfds)
+        pidfds = list(selector.get_map())
+        self.assertEqual(len(pidfds), 3)
+        self.check_finished(processes, running_jobs, self.collect(selector, use_pidfds, running_jobs))
+        self.assertEqual(len(selector.get_map()), 0)
+        for pidfd in pidfds:
+            assert_fd_closed(self, pidfd)
+
+    def test_sigchld_fallback(self):
+        with mock.patch.object(os, "pidfd_open", side_effect=AttributeError, create=True):
+            selector, use_pidfds = make_job_selector()
+        wakeup_read_fd = next(iter(selector.get_map()))
+
+        def restore_signals():
+            os.close(signal.set_wakeup_fd(-1))
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            selector.close()
+            os.close(wakeup_read_fd)
+        self.addCleanup(restore_signals)
+        self.assertFalse(use_pidfds)
+        processes, running_jobs = self.start_jobs(selector, use_pidfds)
+        self.check_finished(processes, running_jobs, self.collect(selector, use_pidfds, running_jobs))
+
+    def test_reap_leaves_unknown_processes(self):
+        selector, use_pidfds = make_job_selector()
+        self.addCleanup(selector.close)
+        if not use_pidfds:
+            self.skipTest("pidfds are not supported here")
+        process = start_child("pass")
+        watch_job(selector, process)
+        exited_processes = []
+        while not exited_processes:
+            exited_processes = wait_for_job_exit(selector)
+        self.assertEqual(reap_finished_jobs({}, exited_processes), [])
+        self.assertEqual(process.returncode, 0)
+
+    def start_ready_child(self, code):
+        ready_read_fd, ready_write_fd = os.pipe()
+        process = start_child(code, pass_fds=(ready_write_fd,), env={**os.environ, "KABUKI_READY_FD": str(ready_write_fd)})
+        os.close(ready_write_fd)
+        self.addCleanup(process.wait)
+        return ready_read_fd, process
+
+    def test_wait_for_ready_signaled(self):
+        ready_read_fd, process = self.start_ready_child("import os, time; os.write(int(os.environ['KABUKI_READY_FD']), b'1'); time.sleep(30)")
+        self.addCleanup(process.kill)
+        start_time = time.monotonic()
+        wait_for_ready(ready_read_fd, timeout=10)
+        self.assertLess(time.monotonic() - start_time, 5)
+        self.assertIsNone(process.poll())
+        assert_fd_closed(self, ready_read_fd)
+
+    def test_wait_for_ready_child_exits(self):
+        ready_read_fd, process = self.start_ready_child("pass")
+        start_time = time.monotonic()
+        wait_for_ready(ready_read_fd, timeout=10)
+        self.assertLess(time.monotonic() - start_time, 5)
+        assert_fd_closed(self, ready_read_fd)
+
+    def test_wait_for_ready_timeout(self):
+        ready_read_fd, ready_write_fd = os.pipe()
+        self.addCleanup(os.close, ready_write_fd)
+        start_time = time.monotonic()
+        wait_for_ready(ready_read_fd, timeout=0.2)
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.15)
+        assert_fd_closed(self, ready_read_fd)